@@ -7,16 +7,15 @@
 # @FileName: dynamics_and_models.py
 # =====================================
 
+from functools import lru_cache
 from math import pi, cos, sin
 
-import bezier
-import matplotlib.pyplot as plt
 import numpy as np
 # import tensorflow as tf
 from numpy import logical_and
 
 # gym.envs.user_defined.toyota_env.
-from gym.envs.user_defined.toyota_3way.endtoend_env_utils import rotate_coordination, L, W, CROSSROAD_SIZE, LANE_WIDTH, LANE_NUMBER, VEHICLE_MODE_LIST
+from gym.envs.user_defined.toyota_3way.endtoend_env_utils import L, W, CROSSROAD_SIZE, LANE_WIDTH, LANE_NUMBER, VEHICLE_MODE_LIST
 
 
 class VehicleDynamics(object):
@@ -35,56 +34,122 @@ class VehicleDynamics(object):
         F_zf, F_zr = b * mass * g / (a + b), a * mass * g / (a + b)
         self.vehicle_params.update(dict(F_zf=F_zf,
                                         F_zr=F_zr))
-
-    def f_xu(self, states, actions, tau):  # states and actions are tensors, [[], [], ...]
+        # scalars used in f_xu, combined once here instead of looked up in the dict on every call
+        C_f, C_r, I_z, miu = self.vehicle_params['C_f'], self.vehicle_params['C_r'], \
+                             self.vehicle_params['I_z'], self.vehicle_params['miu']
+        self._f_xu_params = (C_f, a, b, mass, I_z, F_zf, F_zr,
+                             a * C_f - b * C_r, C_f + C_r, a ** 2 * C_f + b ** 2 * C_r,
+                             (miu * F_zf) ** 2, (miu * F_zr) ** 2)
+
+    def f_xu(self, states, actions, tau, cos_sin_phi=None):  # states and actions are tensors, [[], [], ...]
         v_x, v_y, r, x, y, phi = states[:, 0], states[:, 1], states[:, 2], states[:, 3], states[:, 4], states[:, 5]
         phi = phi * np.pi / 180.
         steer, a_x = actions[:, 0], actions[:, 1]
-        C_f = self.vehicle_params['C_f']
-        C_r = self.vehicle_params['C_r']
-        a = self.vehicle_params['a']
-        b = self.vehicle_params['b']
-        mass = self.vehicle_params['mass']
-        I_z = self.vehicle_params['I_z']
-        miu = self.vehicle_params['miu']
-        g = self.vehicle_params['g']
-
-        F_zf, F_zr = b * mass * g / (a + b), a * mass * g / (a + b)
-        F_xf = np.where(a_x < 0, mass * a_x / 2, np.zeros_like(a_x))
-        F_xr = np.where(a_x < 0, mass * a_x / 2, mass * a_x)
-        miu_f = np.sqrt(np.square(miu * F_zf) - np.square(F_xf)) / F_zf
-        miu_r = np.sqrt(np.square(miu * F_zr) - np.square(F_xr)) / F_zr
-        alpha_f = np.arctan((v_y + a * r) / (v_x+1e-8)) - steer
-        alpha_r = np.arctan((v_y - b * r) / (v_x+1e-8))
-
-        next_state = [v_x + tau * (a_x + v_y * r),
-                      (mass * v_y * v_x + tau * (
-                                  a * C_f - b * C_r) * r - tau * C_f * steer * v_x - tau * mass * np.square(
-                          v_x) * r) / (mass * v_x - tau * (C_f + C_r)),
-                      (-I_z * r * v_x - tau * (a * C_f - b * C_r) * v_y + tau * a * C_f * steer * v_x) / (
-                                  tau * (np.square(a) * C_f + np.square(b) * C_r) - I_z * v_x),
-                      x + tau * (v_x * np.cos(phi) - v_y * np.sin(phi)),
-                      y + tau * (v_x * np.sin(phi) + v_y * np.cos(phi)),
-                      (phi + tau * r) * 180 / np.pi]
-
-        return np.stack(next_state, 1), np.stack([alpha_f, alpha_r, miu_f, miu_r], 1)
-
-    def prediction(self, x_1, u_1, frequency):
-        x_next, next_params = self.f_xu(x_1, u_1, 1 / frequency)
+        C_f, a, b, mass, I_z, F_zf, F_zr, aC_f_bC_r, C_f_C_r, a2C_f_b2C_r, miu_F_zf_2, miu_F_zr_2 = self._f_xu_params
+        cos_phi, sin_phi = (np.cos(phi), np.sin(phi)) if cos_sin_phi is None else cos_sin_phi
+        dtype = np.result_type(states, actions, 1.)
+        next_state = np.empty((len(states), 6), dtype=dtype)
+        next_params = np.empty((len(states), 4), dtype=dtype)
+
+        next_state[:, 0] = v_x + tau * (a_x + v_y * r)
+        next_state[:, 1] = (mass * v_y * v_x + tau * aC_f_bC_r * r - tau * C_f * steer * v_x
+                            - tau * mass * np.square(v_x) * r) / (mass * v_x - tau * C_f_C_r)
+        next_state[:, 2] = (-I_z * r * v_x - tau * aC_f_bC_r * v_y + tau * a * C_f * steer * v_x) / \
+                           (tau * a2C_f_b2C_r - I_z * v_x)
+        next_state[:, 3] = x + tau * (v_x * cos_phi - v_y * sin_phi)
+        next_state[:, 4] = y + tau * (v_x * sin_phi + v_y * cos_phi)
+        next_state[:, 5] = (phi + tau * r) * 180 / np.pi
+
+        F_x = mass * a_x
+        braking = a_x < 0
+        F_xf = np.where(braking, F_x / 2, 0.)
+        F_xr = np.where(braking, F_x / 2, F_x)
+        # the params are evaluated in place on one temporary each and written straight into their column
+        v_x_eps = v_x + 1e-8
+        alpha_f = a * r
+        alpha_f += v_y
+        alpha_f /= v_x_eps
+        np.subtract(np.arctan(alpha_f, out=alpha_f), steer, out=next_params[:, 0])
+        alpha_r = b * r
+        np.subtract(v_y, alpha_r, out=alpha_r)
+        alpha_r /= v_x_eps
+        np.arctan(alpha_r, out=next_params[:, 1])
+        np.subtract(miu_F_zf_2, np.square(F_xf, out=F_xf), out=F_xf)
+        np.divide(np.sqrt(F_xf, out=F_xf), F_zf, out=next_params[:, 2])
+        np.subtract(miu_F_zr_2, np.square(F_xr, out=F_xr), out=F_xr)
+        np.divide(np.sqrt(F_xr, out=F_xr), F_zr, out=next_params[:, 3])
+        return next_state, next_params
+
+    def prediction(self, x_1, u_1, frequency, cos_sin_phi=None):
+        x_next, next_params = self.f_xu(x_1, u_1, 1 / frequency, cos_sin_phi)
         return x_next, next_params
 
 
+def _cos_sin_deg(phis):  # phis in deg
+    phis_rad = phis * np.pi / 180.
+    return np.cos(phis_rad), np.sin(phis_rad)
+
+
+def _soft(margins):  # penalty if violating, i.e. margin < 0
+    return np.square(np.minimum(margins, 0.))
+
+
+def _curb_constraints(task):
+    """
+    :param task: 'left', 'straight' or 'right'
+    :return: margins, regions4training, regions4real, each as (K, 3) homogeneous rows [a_x, a_y, offset]
+    for ego point p, constraint k penalizes the curb margin margins[k]·(p, 1) < 0 (i.e. less than 1m to the curb),
+    only where p is in its region, i.e. regions[k]·(p, 1) < 0
+    """
+    if task == 'left':
+        margins = [[1., 0., -1.],
+                   [-1., 0., LANE_WIDTH - 1],
+                   [0., -1., LANE_WIDTH*LANE_NUMBER - 1],
+                   [0., 1., -1.]]
+        regions4training = [[0., 1., CROSSROAD_SIZE/2],
+                            [0., 1., CROSSROAD_SIZE/2],
+                            [1., 0., 0.],
+                            [1., 0., CROSSROAD_SIZE/2]]
+        regions4real = [[0., 1., CROSSROAD_SIZE/2],
+                        [0., 1., CROSSROAD_SIZE/2],
+                        [1., 0., CROSSROAD_SIZE/2],
+                        [1., 0., CROSSROAD_SIZE/2]]
+    elif task == 'straight':
+        margins = [[1., 0., -LANE_WIDTH - 1],
+                   [-1., 0., 2*LANE_WIDTH - 1],
+                   [-1., 0., LANE_WIDTH*LANE_NUMBER - 1],
+                   [1., 0., -1.]]
+        regions4training = regions4real = [[0., 1., CROSSROAD_SIZE/2],
+                                           [0., 1., CROSSROAD_SIZE/2],
+                                           [0., -1., CROSSROAD_SIZE/2],
+                                           [0., -1., CROSSROAD_SIZE/2]]
+    else:
+        assert task == 'right'
+        margins = [[1., 0., -2*LANE_WIDTH - 1],
+                   [-1., 0., LANE_NUMBER*LANE_WIDTH - 1],
+                   [0., -1., -1.],
+                   [0., 1., LANE_WIDTH*LANE_NUMBER - 1]]
+        regions4training = regions4real = [[0., 1., CROSSROAD_SIZE/2],
+                                           [0., 1., CROSSROAD_SIZE/2],
+                                           [-1., 0., CROSSROAD_SIZE/2],
+                                           [-1., 0., CROSSROAD_SIZE/2]]
+    return np.array(margins, dtype=np.float32), np.array(regions4training, dtype=np.float32), \
+           np.array(regions4real, dtype=np.float32)
+
+
 class EnvironmentModel(object):  # all tensors
     def __init__(self, task, num_future_data=0, costs_mode='penalty'):
         self.task = task
         self.mode = None
         self.vehicle_dynamics = VehicleDynamics()
         self.base_frequency = 10.
-        self.obses = None
+        self._ego, self._track, self._vehs = None, None, None  # vehs are kept in absolute coordination
+        self._obses = None
         self.ego_params = None
         self.actions = None
         self.ref_path = ReferencePath(self.task)
         self.ref_indexes = None
+        self._reduced_ref_paths = None
         self.num_future_data = num_future_data
         self.exp_v = 8.
         self.reward_info = None
@@ -92,25 +157,91 @@ class EnvironmentModel(object):  # all tensors
         self.per_veh_info_dim = 4
         self.per_veh_cstr_dim = 4
         self.per_tracking_info_dim = 3
+        self._veh_start = self.ego_info_dim + self.per_tracking_info_dim * (self.num_future_data + 1)
+        self._veh_nums = None
+        self.dtype = np.float32
+        # the curb margins and both sets of regions are all evaluated by one matmul of the ego points,
+        # the regions4real rows are only appended if they differ from the training ones
+        curb_margins, curb_regions4training, curb_regions4real = _curb_constraints(self.task)
+        self._curb_num = len(curb_margins)
+        self._curb_same_regions = np.array_equal(curb_regions4training, curb_regions4real)
+        curb_rows = np.concatenate([curb_margins, curb_regions4training] +
+                                   ([] if self._curb_same_regions else [curb_regions4real]))
+        self._curb_coeffs, self._curb_offsets = np.ascontiguousarray(curb_rows[:, :2].T), curb_rows[:, 2]
+        # per veh index: +1 for left turn, -1 for right turn, 0 for going straight, and the turning radius
+        self._mode_turn_sign = np.array([1. if mode in ['dl', 'rd', 'ur', 'lu'] else
+                                         -1. if mode in ['dr', 'ru', 'ul', 'ld'] else 0.
+                                         for mode in VEHICLE_MODE_LIST[self.task]], dtype=np.float32)
+        self._mode_radius = np.where(self._mode_turn_sign > 0, CROSSROAD_SIZE/2+0.5*LANE_WIDTH,
+                                     CROSSROAD_SIZE/2-2.5*LANE_WIDTH).astype(np.float32)
         self.rewards_mode = rewards_mode
         self.veh2veh_dists_last = None
+        self._barrier_lambda_args = None
+        self._buffers = {}
+        self._render_fig = None
+
+    @property
+    def obses(self):  # the packed obses with relative vehs, only joined when asked for
+        if self._obses is None and self._ego is not None:
+            self._obses = self._join_obses(self._ego, self._track, self._vehs)
+        return self._obses
+
+    @obses.setter
+    def obses(self, obses):
+        obses = np.asarray(obses, dtype=self.dtype)
+        self._ego, self._track, self._vehs = self._split_obses(obses)
+        self._veh_nums = self._vehs.shape[1]
+        self._obses = obses
+
+    def _split_obses(self, obses):  # -> ego (B, 6), tracking (B, 3*(n+1)), abso vehs (B, veh_nums, 4)
+        ego_infos = obses[:, :self.ego_info_dim].copy()
+        tracking_infos = obses[:, self.ego_info_dim:self._veh_start].copy()
+        veh_infos = np.reshape(obses[:, self._veh_start:], (len(obses), -1, self.per_veh_info_dim)).copy()
+        veh_infos[:, :, :2] += ego_infos[:, np.newaxis, 3:5]
+        return ego_infos, tracking_infos, veh_infos
+
+    def _join_obses(self, ego_infos, tracking_infos, veh_infos):
+        obses = np.empty((len(ego_infos), self._veh_start + veh_infos.shape[1] * self.per_veh_info_dim),
+                         dtype=np.result_type(ego_infos, tracking_infos, veh_infos))
+        obses[:, :self.ego_info_dim] = ego_infos
+        obses[:, self.ego_info_dim:self._veh_start] = tracking_infos
+        rela_veh_infos = obses[:, self._veh_start:].reshape(np.shape(veh_infos))  # a view into obses
+        rela_veh_infos[:] = veh_infos
+        rela_veh_infos[:, :, :2] -= ego_infos[:, np.newaxis, 3:5]
+        return obses
 
     def reset(self, obses, ref_indexes=None):  # input are all tensors
         self.obses = obses
-        self.ref_indexes = ref_indexes
+        self.ref_indexes = None if ref_indexes is None else np.asarray(ref_indexes)
+        # ref_indexes are fixed until the next reset, so the per-row paths searched for the closest point
+        # in every step are gathered once here
+        self._reduced_ref_paths = None if ref_indexes is None else self.ref_path.reduced_paths(self.ref_indexes)
         self.actions = None
         self.reward_info = None
         self.veh2veh_dists_last = 2.5 * np.ones([256, 32])
+        self._buffers = {}
+
+    def _buffer(self, name, shape, dtype):  # scratch array reused across rollout_out calls of the same batch shape
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = self._buffers[name] = np.empty(shape, dtype=dtype)
+        return buf
 
     def add_traj(self, obses, trajectory, mode=None):
         self.obses = obses
         self.ref_path = trajectory
+        self._reduced_ref_paths = None
         self.mode = mode
 
     def rollout_out(self, actions):  # obses and actions are tensors, think of actions are in range [-1, 1]
-        self.actions = self._action_transformation_for_end2end(actions)
-        rewards, punish_term_for_training, real_punish_term, veh2veh4real, veh2road4real = self.compute_rewards(self.obses, self.actions)
-        self.obses = self.compute_next_obses(self.obses, self.actions)
+        self.actions = self._action_transformation_for_end2end(np.asarray(actions, dtype=self.dtype))
+        # the headings are shared by the rewards and the prediction of this step
+        ego_cos_sin, veh_cos_sin = _cos_sin_deg(self._ego[:, 5]), _cos_sin_deg(self._vehs[:, :, 3])
+        rewards, punish_term_for_training, real_punish_term, veh2veh4real, veh2road4real = \
+            self._compute_rewards(self._ego, self._track, self._vehs, self.actions, ego_cos_sin, veh_cos_sin)
+        self._ego, self._track, self._vehs = self._predict_next(self._ego, self._vehs, self.actions,
+                                                                ego_cos_sin, veh_cos_sin)
+        self._obses = None
         return self.obses, rewards, punish_term_for_training, real_punish_term, veh2veh4real, veh2road4real
 
     def _action_transformation_for_end2end(self, actions):  # [-1, 1]
@@ -120,27 +251,25 @@ class EnvironmentModel(object):  # all tensors
         return np.stack([steer_scale, a_xs_scale], 1)
     
     def barrier_lambda_schedule(self, ite):
-        init_lambda = self.args.barrier_lambda_scheduler[0]
-        end_lambda = self.args.barrier_lambda_scheduler[2]
-        end_ite = self.args.barrier_lambda_scheduler[1]
-        interval = self.args.barrier_lambda_interval
+        if self._barrier_lambda_args is None:  # read the scheduler args once, the schedule runs every iteration
+            init_lambda, end_ite, end_lambda = self.args.barrier_lambda_scheduler[:3]
+            interval = self.args.barrier_lambda_interval
+            self._barrier_lambda_args = (init_lambda, end_lambda, end_ite, interval,
+                                         self.args.max_updated_steps // interval)
+        init_lambda, end_lambda, end_ite, interval, interval_num = self._barrier_lambda_args
         if ite <= end_ite:
-            factor =  (ite//interval) / (self.args.max_updated_steps//interval)
-            self.barrier_lambda = (init_lambda - end_lambda) *(1 - factor)  + end_lambda
+            factor = (ite // interval) / interval_num
+            self.barrier_lambda = (init_lambda - end_lambda) * (1 - factor) + end_lambda
         else:
             self.barrier_lambda = end_lambda
         return self.barrier_lambda
 
     def compute_rewards(self, obses, actions):
-        obses = self.convert_vehs_to_abso(obses)
+        return self._compute_rewards(*self._split_obses(np.asarray(obses)), actions)
 
+    def _compute_rewards(self, ego_infos, tracking_infos, vehs, actions, ego_cos_sin=None, veh_cos_sin=None):
+        # vehs: abso, (B, veh_nums, 4)
         # with tf.name_scope('compute_reward') as scope:
-        ego_infos, tracking_infos, veh_infos = obses[:, :self.ego_info_dim], \
-                                               obses[:,
-                                               self.ego_info_dim:self.ego_info_dim + self.per_tracking_info_dim * (
-                                                           self.num_future_data + 1)], \
-                                               obses[:, self.ego_info_dim + self.per_tracking_info_dim * (
-                                                           self.num_future_data + 1):]
         steers, a_xs = actions[:, 0], actions[:, 1]
         # rewards related to action
         punish_steer = -np.square(steers)
@@ -156,96 +285,37 @@ class EnvironmentModel(object):  # all tensors
 
         # rewards related to veh2veh collision
         ego_lws = (L - W) / 2.
-        ego_front_points = ego_infos[:, 3] + ego_lws * np.cos(ego_infos[:, 5] * np.pi / 180.), \
-                           ego_infos[:, 4] + ego_lws * np.sin(ego_infos[:, 5] * np.pi / 180.)
-        ego_rear_points = ego_infos[:, 3] - ego_lws * np.cos(ego_infos[:, 5] * np.pi / 180.), \
-                          ego_infos[:, 4] - ego_lws * np.sin(ego_infos[:, 5] * np.pi / 180.)
-
-        veh_nums = int(np.shape(veh_infos)[1] / self.per_veh_info_dim)
-        veh2veh4real = np.zeros_like(veh_infos[:, 0])
-        veh2veh4training = np.zeros_like(veh_infos[:, 0])
-        veh2veh_dist = np.zeros_like(veh_infos[:, 0])
-        veh2veh_dists = np.zeros([np.shape(veh_infos)[0], self.per_veh_cstr_dim*veh_nums+4])
-
-        for veh_index in range(int(np.shape(veh_infos)[1] / self.per_veh_info_dim)):
-            vehs = veh_infos[:, veh_index * self.per_veh_info_dim:(veh_index + 1) * self.per_veh_info_dim]
-            veh_lws = (L - W) / 2.
-            veh_front_points = vehs[:, 0] + veh_lws * np.cos(vehs[:, 3] * np.pi / 180.), \
-                               vehs[:, 1] + veh_lws * np.sin(vehs[:, 3] * np.pi / 180.)
-            veh_rear_points = vehs[:, 0] - veh_lws * np.cos(vehs[:, 3] * np.pi / 180.), \
-                              vehs[:, 1] - veh_lws * np.sin(vehs[:, 3] * np.pi / 180.)
-            for ego_point in [ego_front_points, ego_rear_points]:
-                for veh_point in [veh_front_points, veh_rear_points]:
-                    veh2veh4training += np.where(veh2veh_dist - 3.5 < 0, np.square(veh2veh_dist - 3.5),
-                                                 np.zeros_like(veh_infos[:, 0]))
-                    veh2veh4real += np.where(veh2veh_dist - 2.5 < 0, veh2veh_dist - 2.5,
-                                             np.zeros_like(veh_infos[:, 0]))
-
-        veh2road4real = np.zeros_like(veh_infos[:, 0])
-        veh2road4training = np.zeros_like(veh_infos[:, 0])
-        if self.task == 'left':
-            for ego_point in [ego_front_points, ego_rear_points]:
-                veh2road4training += np.where(logical_and(ego_point[1] < -CROSSROAD_SIZE/2, ego_point[0] < 1),
-                                     np.square(ego_point[0]-1), np.zeros_like(veh_infos[:, 0]))
-                veh2road4training += np.where(logical_and(ego_point[1] < -CROSSROAD_SIZE/2, LANE_WIDTH-ego_point[0] < 1),
-                                     np.square(LANE_WIDTH-ego_point[0] - 1), np.zeros_like(veh_infos[:, 0]))
-                veh2road4training += np.where(logical_and(ego_point[0] < 0, LANE_WIDTH*LANE_NUMBER - ego_point[1] < 1),
-                                     np.square(LANE_WIDTH*LANE_NUMBER - ego_point[1] - 1), np.zeros_like(veh_infos[:, 0]))
-                veh2road4training += np.where(logical_and(ego_point[0] < -CROSSROAD_SIZE/2, ego_point[1] - 0 < 1),
-                                     np.square(ego_point[1] - 0 - 1), np.zeros_like(veh_infos[:, 0]))
-
-                veh2road4real += np.where(logical_and(ego_point[1] < -CROSSROAD_SIZE/2, ego_point[0] < 1),
-                                     np.square(ego_point[0] - 1), np.zeros_like(veh_infos[:, 0]))
-                veh2road4real += np.where(logical_and(ego_point[1] < -CROSSROAD_SIZE/2, LANE_WIDTH - ego_point[0] < 1),
-                                     np.square(LANE_WIDTH - ego_point[0] - 1), np.zeros_like(veh_infos[:, 0]))
-                veh2road4real += np.where(logical_and(ego_point[0] < -CROSSROAD_SIZE/2, LANE_WIDTH*LANE_NUMBER - ego_point[1] < 1),
-                                     np.square(LANE_WIDTH*LANE_NUMBER - ego_point[1] - 1), np.zeros_like(veh_infos[:, 0]))
-                veh2road4real += np.where(logical_and(ego_point[0] < -CROSSROAD_SIZE/2, ego_point[1] - 0 < 1),
-                                     np.square(ego_point[1] - 0 - 1), np.zeros_like(veh_infos[:, 0]))
-        elif self.task == 'straight':
-            for ego_point in [ego_front_points, ego_rear_points]:
-                veh2road4training += np.where(logical_and(ego_point[1] < -CROSSROAD_SIZE/2, ego_point[0] - LANE_WIDTH < 1),
-                                     np.square(ego_point[0] - LANE_WIDTH -1), np.zeros_like(veh_infos[:, 0]))
-                veh2road4training += np.where(logical_and(ego_point[1] < -CROSSROAD_SIZE/2, 2*LANE_WIDTH-ego_point[0] < 1),
-                                     np.square(2*LANE_WIDTH-ego_point[0] - 1), np.zeros_like(veh_infos[:, 0]))
-                veh2road4training += np.where(logical_and(ego_point[1] > CROSSROAD_SIZE/2, LANE_WIDTH*LANE_NUMBER - ego_point[0] < 1),
-                                     np.square(LANE_WIDTH*LANE_NUMBER - ego_point[0] - 1), np.zeros_like(veh_infos[:, 0]))
-                veh2road4training += np.where(logical_and(ego_point[1] > CROSSROAD_SIZE/2, ego_point[0] - 0 < 1),
-                                     np.square(ego_point[0] - 0 - 1), np.zeros_like(veh_infos[:, 0]))
-
-                veh2road4real += np.where(logical_and(ego_point[1] < -CROSSROAD_SIZE / 2, ego_point[0]-LANE_WIDTH < 1),
-                                              np.square(ego_point[0]-LANE_WIDTH - 1), np.zeros_like(veh_infos[:, 0]))
-                veh2road4real += np.where(
-                    logical_and(ego_point[1] < -CROSSROAD_SIZE / 2, 2 * LANE_WIDTH - ego_point[0] < 1),
-                    np.square(2 * LANE_WIDTH - ego_point[0] - 1), np.zeros_like(veh_infos[:, 0]))
-                veh2road4real += np.where(
-                    logical_and(ego_point[1] > CROSSROAD_SIZE / 2, LANE_WIDTH * LANE_NUMBER - ego_point[0] < 1),
-                    np.square(LANE_WIDTH * LANE_NUMBER - ego_point[0] - 1), np.zeros_like(veh_infos[:, 0]))
-                veh2road4real += np.where(logical_and(ego_point[1] > CROSSROAD_SIZE / 2, ego_point[0] - 0 < 1),
-                                              np.square(ego_point[0] - 0 - 1), np.zeros_like(veh_infos[:, 0]))
+        cos_e, sin_e = _cos_sin_deg(ego_infos[:, 5]) if ego_cos_sin is None else ego_cos_sin
+        ego_front_points = ego_infos[:, 3] + ego_lws * cos_e, ego_infos[:, 4] + ego_lws * sin_e
+        ego_rear_points = ego_infos[:, 3] - ego_lws * cos_e, ego_infos[:, 4] - ego_lws * sin_e
+        ego_pts = np.stack([np.stack(ego_front_points, 1), np.stack(ego_rear_points, 1)], 1)  # (B, 2, 2)
+
+        # all ego/veh point pairs at once: (B, veh_nums, ego point, veh point)
+        veh_lws = (L - W) / 2.
+        veh_offsets = veh_lws * np.stack(_cos_sin_deg(vehs[:, :, 3]) if veh_cos_sin is None else veh_cos_sin, 2)
+        dtype = np.result_type(ego_pts, veh_offsets)
+        veh_pts = self._buffer('veh_pts', np.shape(veh_offsets)[:2] + (2, 2), dtype)  # (B, veh_nums, 2, 2)
+        np.add(vehs[:, :, :2], veh_offsets, out=veh_pts[:, :, 0])
+        np.subtract(vehs[:, :, :2], veh_offsets, out=veh_pts[:, :, 1])
+        deltas = np.subtract(ego_pts[:, np.newaxis, :, np.newaxis, :], veh_pts[:, :, np.newaxis, :, :],
+                             out=self._buffer('veh2veh_deltas', np.shape(veh_pts) + (2,), dtype))
+        veh2veh_dists = np.hypot(deltas[..., 0], deltas[..., 1],
+                                 out=self._buffer('veh2veh_dists', np.shape(veh_pts), dtype))
+        veh2veh_margins = self._buffer('veh2veh_margins', np.shape(veh_pts), dtype)
+        np.minimum(np.subtract(veh2veh_dists, 3.5, out=veh2veh_margins), 0., out=veh2veh_margins)
+        veh2veh4training = np.square(veh2veh_margins, out=veh2veh_margins).sum((1, 2, 3))
+        np.minimum(np.subtract(veh2veh_dists, 2.5, out=veh2veh_margins), 0., out=veh2veh_margins)
+        veh2veh4real = veh2veh_margins.sum((1, 2, 3))
+
+        # rewards related to veh2road collision, summed over both ego points
+        K = self._curb_num
+        curb_values = ego_pts @ self._curb_coeffs + self._curb_offsets  # (B, 2, 2K) or (B, 2, 3K)
+        veh2road_penalties = _soft(curb_values[:, :, :K])
+        veh2road4training = ((curb_values[:, :, K:2*K] < 0) * veh2road_penalties).sum((1, 2))
+        if self._curb_same_regions:
+            veh2road4real = veh2road4training
         else:
-            assert self.task == 'right'
-            for ego_point in [ego_front_points, ego_rear_points]:
-                veh2road4training += np.where(logical_and(ego_point[1] < -CROSSROAD_SIZE/2, ego_point[0] - 2*LANE_WIDTH < 1),
-                                     np.square(ego_point[0] - 2*LANE_WIDTH-1), np.zeros_like(veh_infos[:, 0]))
-                veh2road4training += np.where(logical_and(ego_point[1] < -CROSSROAD_SIZE/2, LANE_NUMBER*LANE_WIDTH-ego_point[0] < 1),
-                                     np.square(LANE_NUMBER*LANE_WIDTH-ego_point[0] - 1), np.zeros_like(veh_infos[:, 0]))
-                veh2road4training += np.where(logical_and(ego_point[0] > CROSSROAD_SIZE/2, 0 - ego_point[1] < 1),
-                                     np.square(0 - ego_point[1] - 1), np.zeros_like(veh_infos[:, 0]))
-                veh2road4training += np.where(logical_and(ego_point[0] > CROSSROAD_SIZE/2, ego_point[1] - (-LANE_WIDTH*LANE_NUMBER) < 1),
-                                     np.square(ego_point[1] - (-LANE_WIDTH*LANE_NUMBER) - 1), np.zeros_like(veh_infos[:, 0]))
-
-                veh2road4real += np.where(
-                    logical_and(ego_point[1] < -CROSSROAD_SIZE / 2, ego_point[0] - 2 * LANE_WIDTH < 1),
-                    np.square(ego_point[0] - 2 * LANE_WIDTH - 1), np.zeros_like(veh_infos[:, 0]))
-                veh2road4real += np.where(
-                    logical_and(ego_point[1] < -CROSSROAD_SIZE / 2, LANE_NUMBER * LANE_WIDTH - ego_point[0] < 1),
-                    np.square(LANE_NUMBER * LANE_WIDTH - ego_point[0] - 1), np.zeros_like(veh_infos[:, 0]))
-                veh2road4real += np.where(logical_and(ego_point[0] > CROSSROAD_SIZE / 2, 0 - ego_point[1] < 1),
-                                              np.square(0 - ego_point[1] - 1), np.zeros_like(veh_infos[:, 0]))
-                veh2road4real += np.where(
-                    logical_and(ego_point[0] > CROSSROAD_SIZE / 2, ego_point[1] - (-LANE_WIDTH * LANE_NUMBER) < 1),
-                    np.square(ego_point[1] - (-LANE_WIDTH * LANE_NUMBER) - 1), np.zeros_like(veh_infos[:, 0]))
+            veh2road4real = ((curb_values[:, :, 2*K:] < 0) * veh2road_penalties).sum((1, 2))
 
         rewards = 0.05 * devi_v + 0.8 * devi_y + 30 * devi_phi + 0.02 * punish_yaw_rate + \
                   5 * punish_steer + 0.05 * punish_a_x
@@ -256,14 +326,12 @@ class EnvironmentModel(object):  # all tensors
 
 
     def compute_next_obses(self, obses, actions):
-        obses = self.convert_vehs_to_abso(obses)
-        ego_infos, tracking_infos, veh_infos = obses[:, :self.ego_info_dim], obses[:,
-                                                                             self.ego_info_dim:self.ego_info_dim + self.per_tracking_info_dim * (
-                                                                                         self.num_future_data + 1)], \
-                                               obses[:, self.ego_info_dim + self.per_tracking_info_dim * (
-                                                           self.num_future_data + 1):]
-
-        next_ego_infos = self.ego_predict(ego_infos, actions)
+        ego_infos, _, veh_infos = self._split_obses(np.asarray(obses))
+        return self._join_obses(*self._predict_next(ego_infos, veh_infos, actions))
+
+    def _predict_next(self, ego_infos, veh_infos, actions, ego_cos_sin=None, veh_cos_sin=None):
+        # veh_infos: abso, (B, veh_nums, 4)
+        next_ego_infos = self.ego_predict(ego_infos, actions, ego_cos_sin)
         # different for training and selecting
         if self.mode == 'selecting':
             next_tracking_infos = self.ref_path.tracking_error_vector(next_ego_infos[:, 3],
@@ -273,54 +341,39 @@ class EnvironmentModel(object):  # all tensors
                                                                       self.num_future_data)
         else:
             # next_tracking_infos = self.tracking_error_predict(ego_infos, tracking_infos, actions)
-            next_tracking_infos = np.zeros(shape=(len(next_ego_infos),
-                                                  (self.num_future_data+1)*self.per_tracking_info_dim))
-            ref_indexes = np.expand_dims(self.ref_indexes, axis=1)
-            for ref_idx, path in enumerate(self.ref_path.path_list):
-                self.ref_path.path = path
-                tracking_info_4_this_ref_idx = self.ref_path.tracking_error_vector(next_ego_infos[:, 3],
-                                                                                   next_ego_infos[:, 4],
-                                                                                   next_ego_infos[:, 5],
-                                                                                   next_ego_infos[:, 0],
-                                                                                   self.num_future_data)
-                next_tracking_infos = np.where(ref_indexes == ref_idx, tracking_info_4_this_ref_idx,
-                                               next_tracking_infos)
-
-        next_veh_infos = self.veh_predict(veh_infos)
-        next_obses = np.concatenate((next_ego_infos, next_tracking_infos, next_veh_infos), axis=1)
-        next_obses = self.convert_vehs_to_rela(next_obses)
-        return next_obses
+            # each row only gets the tracking error w.r.t. its own ref path
+            next_tracking_infos = self.ref_path.tracking_error_vector_batched(next_ego_infos[:, 3],
+                                                                              next_ego_infos[:, 4],
+                                                                              next_ego_infos[:, 5],
+                                                                              next_ego_infos[:, 0],
+                                                                              self.num_future_data,
+                                                                              self.ref_indexes,
+                                                                              reduced_paths=self._reduced_ref_paths)
+
+        next_veh_infos = np.reshape(self.veh_predict(np.reshape(veh_infos, (len(veh_infos), -1)), veh_cos_sin),
+                                    np.shape(veh_infos))
+        return next_ego_infos, next_tracking_infos, next_veh_infos
 
     def convert_vehs_to_rela(self, obs_abso):
-        ego_infos, tracking_infos, veh_infos = obs_abso[:, :self.ego_info_dim], \
-                                               obs_abso[:, self.ego_info_dim:self.ego_info_dim + self.per_tracking_info_dim * (
-                                                         self.num_future_data + 1)], \
-                                               obs_abso[:, self.ego_info_dim + self.per_tracking_info_dim * (
-                                                           self.num_future_data + 1):]
-        ego_x, ego_y = ego_infos[:, 3], ego_infos[:, 4]
-        ego = np.tile(np.stack([ego_x, ego_y, np.zeros_like(ego_x), np.zeros_like(ego_x)], 1),
-                      (1, int(np.shape(veh_infos)[1]/self.per_veh_info_dim)))
-        vehs_rela = veh_infos - ego
-        # out = tf.concat([ego_infos, tracking_infos, vehs_rela], 1)
-        out = np.concatenate((ego_infos, tracking_infos, vehs_rela), axis=1)
-        return out
+        return self._shift_vehs(obs_abso, -1.)
 
     def convert_vehs_to_abso(self, obs_rela):
-        ego_infos, tracking_infos, veh_rela = obs_rela[:, :self.ego_info_dim], \
-                                               obs_rela[:, self.ego_info_dim:self.ego_info_dim + self.per_tracking_info_dim * (
-                                                       self.num_future_data + 1)], \
-                                               obs_rela[:, self.ego_info_dim + self.per_tracking_info_dim * (
-                                                       self.num_future_data + 1):]
-        ego_x, ego_y = ego_infos[:, 3], ego_infos[:, 4]
-        ego = np.tile(np.stack([ego_x, ego_y, np.zeros_like(ego_x), np.zeros_like(ego_x)], 1),
-                      (1, int(np.shape(veh_rela)[1] / self.per_veh_info_dim)))
-        vehs_abso = veh_rela + ego
-        # out = tf.concat([ego_infos, tracking_infos, vehs_abso], 1)
-        out = np.concatenate((ego_infos, tracking_infos, vehs_abso), axis=1)
+        return self._shift_vehs(obs_rela, 1.)
+
+    def _shift_vehs(self, obses, sign):  # add sign * (ego_x, ego_y) to the position of every veh
+        obses = np.asarray(obses)
+        veh_start = self._veh_start
+        ego = np.zeros((len(obses), 1, self.per_veh_info_dim), dtype=obses.dtype)
+        ego[:, 0, :2] = sign * obses[:, 3:5]
+        out = np.empty_like(obses)
+        out[:, :veh_start] = obses[:, :veh_start]
+        out[:, veh_start:] = np.reshape(np.reshape(obses[:, veh_start:], (len(obses), -1, self.per_veh_info_dim)) + ego,
+                                        (len(obses), -1))
         return out
 
-    def ego_predict(self, ego_infos, actions):
-        ego_next_infos, _ = self.vehicle_dynamics.prediction(ego_infos[:, :6], actions, self.base_frequency)
+    def ego_predict(self, ego_infos, actions, cos_sin_phi=None):
+        ego_next_infos, _ = self.vehicle_dynamics.prediction(ego_infos[:, :6], actions, self.base_frequency,
+                                                             cos_sin_phi)
         v_xs, v_ys, rs, xs, ys, phis = ego_next_infos[:, 0], ego_next_infos[:, 1], ego_next_infos[:, 2], \
                                        ego_next_infos[:, 3], ego_next_infos[:, 4], ego_next_infos[:, 5]
         v_xs = np.clip(v_xs, 0., 35.)
@@ -338,109 +391,122 @@ class EnvironmentModel(object):  # all tensors
         next_tracking_infos = np.stack((delta_ys_tp1, delta_phis_tp1, v_xs_tp1-self.exp_v), axis=1)
         return next_tracking_infos
 
-    def veh_predict(self, veh_infos):
-        veh_mode_list = VEHICLE_MODE_LIST[self.task]
-        predictions_to_be_concat = []
-
-        for vehs_index in range(len(veh_mode_list)):
-            predictions_to_be_concat.append(self.predict_for_a_mode(
-                veh_infos[:, vehs_index * self.per_veh_info_dim:(vehs_index + 1) * self.per_veh_info_dim],
-                veh_mode_list[vehs_index]))
-        return np.concatenate(predictions_to_be_concat, axis=1)
-
-    def predict_for_a_mode(self, vehs, mode):
-        veh_xs, veh_ys, veh_vs, veh_phis = vehs[:, 0], vehs[:, 1], vehs[:, 2], vehs[:, 3]
+    def veh_predict(self, veh_infos, cos_sin_phis=None):
+        vehs = np.reshape(veh_infos, (len(veh_infos), -1, self.per_veh_info_dim))
+        veh_xs, veh_ys, veh_vs, veh_phis = vehs[:, :, 0], vehs[:, :, 1], vehs[:, :, 2], vehs[:, :, 3]
         veh_phis_rad = veh_phis * np.pi / 180.
+        cos_phis, sin_phis = (np.cos(veh_phis_rad), np.sin(veh_phis_rad)) if cos_sin_phis is None else cos_sin_phis
 
         middle_cond = logical_and(logical_and(veh_xs > -CROSSROAD_SIZE/2, veh_xs < CROSSROAD_SIZE/2),
                                   logical_and(veh_ys > -CROSSROAD_SIZE/2, veh_ys < CROSSROAD_SIZE/2))
-        zeros = np.zeros_like(veh_xs)
 
-        veh_xs_delta = veh_vs / self.base_frequency * np.cos(veh_phis_rad)
-        veh_ys_delta = veh_vs / self.base_frequency * np.sin(veh_phis_rad)
+        veh_xs_delta = veh_vs / self.base_frequency * cos_phis
+        veh_ys_delta = veh_vs / self.base_frequency * sin_phis
+        # turning vehs follow a circle while in the crossroad, straight ones have zero turn sign
+        veh_phis_rad_delta = middle_cond * self._mode_turn_sign * (veh_vs / self._mode_radius) / self.base_frequency
 
-        if mode in ['dl', 'rd', 'ur', 'lu']:
-            veh_phis_rad_delta = np.where(middle_cond, (veh_vs / (CROSSROAD_SIZE/2+0.5*LANE_WIDTH)) / self.base_frequency, zeros)
-        elif mode in ['dr', 'ru', 'ul', 'ld']:
-            veh_phis_rad_delta = np.where(middle_cond, -(veh_vs / (CROSSROAD_SIZE/2-2.5*LANE_WIDTH)) / self.base_frequency, zeros)
-        else:
-            veh_phis_rad_delta = zeros
         next_veh_xs, next_veh_ys, next_veh_vs, next_veh_phis_rad = \
             veh_xs + veh_xs_delta, veh_ys + veh_ys_delta, veh_vs, veh_phis_rad + veh_phis_rad_delta
-        next_veh_phis_rad = np.where(next_veh_phis_rad > np.pi, next_veh_phis_rad - 2 * np.pi, next_veh_phis_rad)
-        next_veh_phis_rad = np.where(next_veh_phis_rad <= -np.pi, next_veh_phis_rad + 2 * np.pi, next_veh_phis_rad)
+        next_veh_phis_rad = np.pi - np.mod(np.pi - next_veh_phis_rad, 2 * np.pi)  # wrap into (-pi, pi]
         next_veh_phis = next_veh_phis_rad * 180 / np.pi
-        return np.stack((next_veh_xs, next_veh_ys, next_veh_vs, next_veh_phis), 1)
+        return np.reshape(np.stack((next_veh_xs, next_veh_ys, next_veh_vs, next_veh_phis), 2), (len(veh_infos), -1))
+
+    def _init_render(self):
+        import matplotlib.pyplot as plt  # only needed for rendering, kept out of the training import path
+        # plot basic map, drawn once and cached as the background that every frame is blitted onto
+        square_length = CROSSROAD_SIZE
+        extension = 40
+        lane_width = LANE_WIDTH
+        dotted_line_style = '--'
+        solid_line_style = '-'
+
+        plt.ion()
+        fig = plt.figure(layout='constrained')
+        ax = fig.add_subplot(xlim=(-square_length / 2 - extension, square_length / 2 + extension),
+                             ylim=(-square_length / 2 - extension, square_length / 2 + extension))
+        ax.set_title("Crossroad")
+        ax.axis("equal")
+        ax.axis('off')
+
+        # ax.add_patch(plt.Rectangle((-square_length / 2, -square_length / 2),
+        #                            square_length, square_length, edgecolor='black', facecolor='none'))
+        ax.add_patch(plt.Rectangle((-square_length / 2 - extension, -square_length / 2 - extension),
+                                   square_length + 2 * extension, square_length + 2 * extension, edgecolor='black',
+                                   facecolor='none'))
+
+        # ----------horizon--------------
+        ax.plot([-square_length / 2 - extension, -square_length / 2], [0, 0], color='black')
+        ax.plot([square_length / 2 + extension, square_length / 2], [0, 0], color='black')
+
+        #
+        for i in range(1, LANE_NUMBER+1):
+            linestyle = dotted_line_style if i < LANE_NUMBER else solid_line_style
+            ax.plot([-square_length / 2 - extension, -square_length / 2], [i*lane_width, i*lane_width],
+                    linestyle=linestyle, color='black')
+            ax.plot([square_length / 2 + extension, square_length / 2], [i*lane_width, i*lane_width],
+                    linestyle=linestyle, color='black')
+            ax.plot([-square_length / 2 - extension, -square_length / 2], [-i * lane_width, -i * lane_width],
+                    linestyle=linestyle, color='black')
+            ax.plot([square_length / 2 + extension, square_length / 2], [-i * lane_width, -i * lane_width],
+                    linestyle=linestyle, color='black')
+
+        # ----------vertical----------------
+        ax.plot([0, 0], [-square_length / 2 - extension, -square_length / 2], color='black')
+        ax.plot([0, 0], [square_length / 2 + extension, square_length / 2], color='black')
+
+        #
+        for i in range(1, LANE_NUMBER+1):
+            linestyle = dotted_line_style if i < LANE_NUMBER else solid_line_style
+            ax.plot([i*lane_width, i*lane_width], [-square_length / 2 - extension, -square_length / 2],
+                    linestyle=linestyle, color='black')
+            ax.plot([i*lane_width, i*lane_width], [square_length / 2 + extension, square_length / 2],
+                    linestyle=linestyle, color='black')
+            ax.plot([-i * lane_width, -i * lane_width], [-square_length / 2 - extension, -square_length / 2],
+                    linestyle=linestyle, color='black')
+            ax.plot([-i * lane_width, -i * lane_width], [square_length / 2 + extension, square_length / 2],
+                    linestyle=linestyle, color='black')
+
+        # ----------stop line--------------
+        ax.plot([0, LANE_NUMBER * lane_width], [-square_length / 2, -square_length / 2], color='black')
+        ax.plot([-LANE_NUMBER * lane_width, 0], [square_length / 2, square_length / 2], color='black')
+        ax.plot([-square_length / 2, -square_length / 2], [0, -LANE_NUMBER * lane_width], color='black')
+        ax.plot([square_length / 2, square_length / 2], [LANE_NUMBER * lane_width, 0], color='black')
+
+        # ----------Oblique--------------
+        ax.plot([LANE_NUMBER * lane_width, square_length / 2], [-square_length / 2, -LANE_NUMBER * lane_width],
+                color='black')
+        ax.plot([LANE_NUMBER * lane_width, square_length / 2], [square_length / 2, LANE_NUMBER * lane_width],
+                color='black')
+        ax.plot([-LANE_NUMBER * lane_width, -square_length / 2], [-square_length / 2, -LANE_NUMBER * lane_width],
+                color='black')
+        ax.plot([-LANE_NUMBER * lane_width, -square_length / 2], [square_length / 2, LANE_NUMBER * lane_width],
+                color='black')
+
+        # the animated artists are left out of the full draw and only updated and blitted in render
+        def car_artists(color):
+            return ax.plot([], [], color=color, animated=True)[0], \
+                   ax.plot([], [], color=color, linewidth=0.5, animated=True)[0]
+
+        self._render_fig, self._render_ax = fig, ax
+        self._render_vehs = [car_artists('black') for _ in range(self._veh_nums)]
+        self._render_ego = car_artists('red')
+        self._render_texts = [ax.text(-110, 60 - 4 * i, '', animated=True) for i in range(11)]
+        self._render_reward_texts = []
+        self._render_background = None
+        fig.canvas.mpl_connect('draw_event', self._on_render_draw)
+        plt.show(block=False)
+        plt.pause(0.1)
+
+    def _on_render_draw(self, event):  # the background is cached again whenever the whole figure is redrawn
+        self._render_background = self._render_fig.canvas.copy_from_bbox(self._render_fig.bbox)
 
     def render(self, mode='human'):
         if mode == 'human':
-            # plot basic map
+            if self._render_fig is None:
+                self._init_render()
             square_length = CROSSROAD_SIZE
             extension = 40
-            lane_width = LANE_WIDTH
-            dotted_line_style = '--'
-            solid_line_style = '-'
-
-            plt.cla()
-            plt.title("Crossroad")
-            ax = plt.axes(xlim=(-square_length / 2 - extension, square_length / 2 + extension),
-                          ylim=(-square_length / 2 - extension, square_length / 2 + extension))
-            plt.axis("equal")
-            plt.axis('off')
-
-            # ax.add_patch(plt.Rectangle((-square_length / 2, -square_length / 2),
-            #                            square_length, square_length, edgecolor='black', facecolor='none'))
-            ax.add_patch(plt.Rectangle((-square_length / 2 - extension, -square_length / 2 - extension),
-                                       square_length + 2 * extension, square_length + 2 * extension, edgecolor='black',
-                                       facecolor='none'))
-
-            # ----------horizon--------------
-            plt.plot([-square_length / 2 - extension, -square_length / 2], [0, 0], color='black')
-            plt.plot([square_length / 2 + extension, square_length / 2], [0, 0], color='black')
-
-            #
-            for i in range(1, LANE_NUMBER+1):
-                linestyle = dotted_line_style if i < LANE_NUMBER else solid_line_style
-                plt.plot([-square_length / 2 - extension, -square_length / 2], [i*lane_width, i*lane_width],
-                         linestyle=linestyle, color='black')
-                plt.plot([square_length / 2 + extension, square_length / 2], [i*lane_width, i*lane_width],
-                         linestyle=linestyle, color='black')
-                plt.plot([-square_length / 2 - extension, -square_length / 2], [-i * lane_width, -i * lane_width],
-                         linestyle=linestyle, color='black')
-                plt.plot([square_length / 2 + extension, square_length / 2], [-i * lane_width, -i * lane_width],
-                         linestyle=linestyle, color='black')
-
-            # ----------vertical----------------
-            plt.plot([0, 0], [-square_length / 2 - extension, -square_length / 2], color='black')
-            plt.plot([0, 0], [square_length / 2 + extension, square_length / 2], color='black')
-
-            #
-            for i in range(1, LANE_NUMBER+1):
-                linestyle = dotted_line_style if i < LANE_NUMBER else solid_line_style
-                plt.plot([i*lane_width, i*lane_width], [-square_length / 2 - extension, -square_length / 2],
-                         linestyle=linestyle, color='black')
-                plt.plot([i*lane_width, i*lane_width], [square_length / 2 + extension, square_length / 2],
-                         linestyle=linestyle, color='black')
-                plt.plot([-i * lane_width, -i * lane_width], [-square_length / 2 - extension, -square_length / 2],
-                         linestyle=linestyle, color='black')
-                plt.plot([-i * lane_width, -i * lane_width], [square_length / 2 + extension, square_length / 2],
-                         linestyle=linestyle, color='black')
-
-            # ----------stop line--------------
-            plt.plot([0, LANE_NUMBER * lane_width], [-square_length / 2, -square_length / 2], color='black')
-            plt.plot([-LANE_NUMBER * lane_width, 0], [square_length / 2, square_length / 2], color='black')
-            plt.plot([-square_length / 2, -square_length / 2], [0, -LANE_NUMBER * lane_width], color='black')
-            plt.plot([square_length / 2, square_length / 2], [LANE_NUMBER * lane_width, 0], color='black')
-
-            # ----------Oblique--------------
-            plt.plot([LANE_NUMBER * lane_width, square_length / 2], [-square_length / 2, -LANE_NUMBER * lane_width],
-                     color='black')
-            plt.plot([LANE_NUMBER * lane_width, square_length / 2], [square_length / 2, LANE_NUMBER * lane_width],
-                     color='black')
-            plt.plot([-LANE_NUMBER * lane_width, -square_length / 2], [-square_length / 2, -LANE_NUMBER * lane_width],
-                     color='black')
-            plt.plot([-LANE_NUMBER * lane_width, -square_length / 2], [square_length / 2, LANE_NUMBER * lane_width],
-                     color='black')
+            fig, ax = self._render_fig, self._render_ax
 
             def is_in_plot_area(x, y, tolerance=5):
                 if -square_length / 2 - extension + tolerance < x < square_length / 2 + extension - tolerance and \
@@ -449,81 +515,138 @@ class EnvironmentModel(object):  # all tensors
                 else:
                     return False
 
-            def draw_rotate_rec(x, y, a, l, w, color):
-                RU_x, RU_y, _ = rotate_coordination(l / 2, w / 2, 0, -a)
-                RD_x, RD_y, _ = rotate_coordination(l / 2, -w / 2, 0, -a)
-                LU_x, LU_y, _ = rotate_coordination(-l / 2, w / 2, 0, -a)
-                LD_x, LD_y, _ = rotate_coordination(-l / 2, -w / 2, 0, -a)
-                ax.plot([RU_x + x, RD_x + x], [RU_y + y, RD_y + y], color=color)
-                ax.plot([RU_x + x, LU_x + x], [RU_y + y, LU_y + y], color=color)
-                ax.plot([LD_x + x, RD_x + x], [LD_y + y, RD_y + y], color=color)
-                ax.plot([LD_x + x, LU_x + x], [LD_y + y, LU_y + y], color=color)
-
-            def plot_phi_line(x, y, phi, color):
+            def update_car(artists, x, y, phi):  # rectangle outline and heading line
+                rec, phi_line = artists
+                cos_phi, sin_phi = cos(phi * pi / 180.), sin(phi * pi / 180.)
+                rec.set_data(x + _CAR_OUTLINE[0] * cos_phi - _CAR_OUTLINE[1] * sin_phi,
+                             y + _CAR_OUTLINE[0] * sin_phi + _CAR_OUTLINE[1] * cos_phi)
                 line_length = 3
-                x_forw, y_forw = x + line_length * cos(phi * pi / 180.), \
-                                 y + line_length * sin(phi * pi / 180.)
-                plt.plot([x, x_forw], [y, y_forw], color=color, linewidth=0.5)
-
-            abso_obs = self.convert_vehs_to_abso(self.obses)
-            obses = abso_obs.numpy()
-            ego_info, tracing_info, vehs_info = obses[0, :self.ego_info_dim], \
-                                                obses[0, self.ego_info_dim:self.ego_info_dim + self.per_tracking_info_dim * (
-                                                                                          self.num_future_data + 1)], \
-                                                obses[0, self.ego_info_dim + self.per_tracking_info_dim * (
-                                                            self.num_future_data + 1):]
+                phi_line.set_data([x, x + line_length * cos_phi], [y, y + line_length * sin_phi])
+
+            ego_info, tracing_info, vehs_info = self._ego[0], self._track[0], self._vehs[0]
             # plot cars
-            for veh_index in range(int(len(vehs_info) / self.per_veh_info_dim)):
-                veh = vehs_info[self.per_veh_info_dim * veh_index:self.per_veh_info_dim * (veh_index + 1)]
+            for artists, veh in zip(self._render_vehs, vehs_info):
                 veh_x, veh_y, veh_v, veh_phi = veh
-
-                if is_in_plot_area(veh_x, veh_y):
-                    plot_phi_line(veh_x, veh_y, veh_phi, 'black')
-                    draw_rotate_rec(veh_x, veh_y, veh_phi, L, W, 'black')
+                in_plot_area = is_in_plot_area(veh_x, veh_y)
+                for artist in artists:
+                    artist.set_visible(in_plot_area)
+                if in_plot_area:
+                    update_car(artists, veh_x, veh_y, veh_phi)
 
             # plot own car
             delta_y, delta_phi = tracing_info[0], tracing_info[1]
             ego_v_x, ego_v_y, ego_r, ego_x, ego_y, ego_phi = ego_info
-
-            plot_phi_line(ego_x, ego_y, ego_phi, 'red')
-            draw_rotate_rec(ego_x, ego_y, ego_phi, L, W, 'red')
+            update_car(self._render_ego, ego_x, ego_y, ego_phi)
 
             # plot text
-            text_x, text_y_start = -110, 60
-            ge = iter(range(0, 1000, 4))
-            plt.text(text_x, text_y_start - next(ge), 'ego_x: {:.2f}m'.format(ego_x))
-            plt.text(text_x, text_y_start - next(ge), 'ego_y: {:.2f}m'.format(ego_y))
-            plt.text(text_x, text_y_start - next(ge), 'delta_y: {:.2f}m'.format(delta_y))
-            plt.text(text_x, text_y_start - next(ge), r'ego_phi: ${:.2f}\degree$'.format(ego_phi))
-            plt.text(text_x, text_y_start - next(ge), r'delta_phi: ${:.2f}\degree$'.format(delta_phi))
-
-            plt.text(text_x, text_y_start - next(ge), 'v_x: {:.2f}m/s'.format(ego_v_x))
-            plt.text(text_x, text_y_start - next(ge), 'exp_v: {:.2f}m/s'.format(self.exp_v))
-            plt.text(text_x, text_y_start - next(ge), 'v_y: {:.2f}m/s'.format(ego_v_y))
-            plt.text(text_x, text_y_start - next(ge), 'yaw_rate: {:.2f}rad/s'.format(ego_r))
-
+            texts = ['ego_x: {:.2f}m'.format(ego_x),
+                     'ego_y: {:.2f}m'.format(ego_y),
+                     'delta_y: {:.2f}m'.format(delta_y),
+                     r'ego_phi: ${:.2f}\degree$'.format(ego_phi),
+                     r'delta_phi: ${:.2f}\degree$'.format(delta_phi),
+                     'v_x: {:.2f}m/s'.format(ego_v_x),
+                     'exp_v: {:.2f}m/s'.format(self.exp_v),
+                     'v_y: {:.2f}m/s'.format(ego_v_y),
+                     'yaw_rate: {:.2f}rad/s'.format(ego_r)]
             if self.actions is not None:
                 steer, a_x = self.actions[0, 0], self.actions[0, 1]
-                plt.text(text_x, text_y_start - next(ge),
-                         r'steer: {:.2f}rad (${:.2f}\degree$)'.format(steer, steer * 180 / np.pi))
-                plt.text(text_x, text_y_start - next(ge), 'a_x: {:.2f}m/s^2'.format(a_x))
-
-            text_x, text_y_start = 70, 60
-            ge = iter(range(0, 1000, 4))
+                texts += [r'steer: {:.2f}rad (${:.2f}\degree$)'.format(steer, steer * 180 / np.pi),
+                          'a_x: {:.2f}m/s^2'.format(a_x)]
+            for i, artist in enumerate(self._render_texts):
+                artist.set_text(texts[i] if i < len(texts) else '')
 
             # reward info
-            if self.reward_info is not None:
-                for key, val in self.reward_info.items():
-                    plt.text(text_x, text_y_start - next(ge), '{}: {:.4f}'.format(key, val))
-
-            plt.show()
-            plt.pause(0.1)
-
-
-def deal_with_phi_diff(phi_diff):
-    phi_diff = np.where(phi_diff > 180., phi_diff - 360., phi_diff)
-    phi_diff = np.where(phi_diff < -180., phi_diff + 360., phi_diff)
-    return phi_diff
+            reward_texts = ['{}: {:.4f}'.format(key, val) for key, val in self.reward_info.items()] \
+                if self.reward_info is not None else []
+            while len(self._render_reward_texts) < len(reward_texts):
+                self._render_reward_texts.append(ax.text(70, 60 - 4 * len(self._render_reward_texts), '',
+                                                         animated=True))
+            for i, artist in enumerate(self._render_reward_texts):
+                artist.set_text(reward_texts[i] if i < len(reward_texts) else '')
+
+            if self._render_background is None:
+                fig.canvas.draw()
+            fig.canvas.restore_region(self._render_background)
+            for artist in [artist for artists in self._render_vehs + [self._render_ego] for artist in artists] + \
+                    self._render_texts + self._render_reward_texts:
+                ax.draw_artist(artist)
+            fig.canvas.blit(fig.bbox)
+            fig.canvas.flush_events()
+
+    def close(self):  # drops the render figure from pyplot's manager, call when done with the model
+        if self._render_fig is not None:
+            import matplotlib.pyplot as plt
+            plt.close(self._render_fig)
+            self._render_fig = None
+
+
+def eval_cubic_bezier(p0, p1, p2, p3, s_vals):
+    """
+    :param p0, p1, p2, p3: control points (x, y) of the cubic bezier curve
+    :param s_vals: curve parameters in [0, 1]
+    :return: points on the curve, [xs, ys], in the precision of s_vals, same as
+    bezier.Curve(np.asfortranarray([[x0, x1, x2, x3], [y0, y1, y2, y3]]), degree=3).evaluate_multi(s_vals)
+    """
+    s = np.asarray(s_vals, dtype=np.result_type(s_vals, np.float32))
+    u = 1. - s
+    bernstein = u * u * u, 3. * u * u * s, 3. * u * s * s, s * s * s
+    points = np.empty((2, len(s)), dtype=s.dtype)
+    for dim in range(2):
+        points[dim] = p0[dim] * bernstein[0] + p1[dim] * bernstein[1] + p2[dim] * bernstein[2] + \
+                      p3[dim] * bernstein[3]
+    return points
+
+
+def deal_with_phi_diff(phi_diff):  # wrap into [-180, 180], round gives 0 turns for values already in range
+    return phi_diff - 360. * np.round(phi_diff / 360.)
+
+
+@lru_cache(maxsize=None)
+def _import_ckdtree():  # scipy is optional, find_closest_point falls back to brute force without it
+    try:
+        from scipy.spatial import cKDTree
+    except ImportError:
+        return None
+    return cKDTree
+
+
+# smaller batches are searched faster by the broadcast scan than through the tree, measured on the static paths
+_KDTREE_MIN_QUERIES = 192
+_RAD2DEG = 180. / pi
+_CAR_OUTLINE = np.array([[L / 2, L / 2, -L / 2, -L / 2, L / 2],
+                         [W / 2, -W / 2, -W / 2, W / 2, W / 2]])  # closed car rectangle at the origin, heading +x
+_HALF_CROSSROAD = CROSSROAD_SIZE / 2
+
+
+def _xys2path(xys):  # (2, N + 1) points -> (3, N) path of the first N points with the heading to the next point
+    phis = np.arctan2(np.diff(xys[1]), np.diff(xys[0]))
+    phis *= _RAD2DEG
+    return np.stack([xys[0, :-1], xys[1, :-1], phis])
+
+
+# signed lateral error of ego to the ref point, one function per task, picked once in ReferencePath.__init__
+def _two2one_left(ego_xs, ego_ys, ref_xs, ref_ys):
+    delta_ = np.hypot(ego_xs - (-_HALF_CROSSROAD), ego_ys - (-_HALF_CROSSROAD)) - \
+             np.hypot(ref_xs - (-_HALF_CROSSROAD), ref_ys - (-_HALF_CROSSROAD))
+    delta_ = np.where(ego_ys < -_HALF_CROSSROAD, ego_xs - ref_xs, delta_)
+    delta_ = np.where(ego_xs < -_HALF_CROSSROAD, ego_ys - ref_ys, delta_)
+    return -delta_
+
+
+def _two2one_straight(ego_xs, ego_ys, ref_xs, ref_ys):
+    return ref_xs - ego_xs
+
+
+def _two2one_right(ego_xs, ego_ys, ref_xs, ref_ys):
+    delta_ = -(np.hypot(ego_xs - _HALF_CROSSROAD, ego_ys - (-_HALF_CROSSROAD)) -
+               np.hypot(ref_xs - _HALF_CROSSROAD, ref_ys - (-_HALF_CROSSROAD)))
+    delta_ = np.where(ego_ys < -_HALF_CROSSROAD, ego_xs - ref_xs, delta_)
+    delta_ = np.where(ego_xs > _HALF_CROSSROAD, -(ego_ys - ref_ys), delta_)
+    return -delta_
+
+
+_TWO2ONE = dict(left=_two2one_left, straight=_two2one_straight, right=_two2one_right)
+_PATH_CACHE = {}  # (task, map params) -> (path_list, path_len_list, path_stack), the paths only depend on the map
 
 
 class ReferencePath(object):
@@ -532,16 +655,32 @@ class ReferencePath(object):
         self.traj_mode = None
         self.exp_v = 8.
         self.task = task
+        self._two2one = _TWO2ONE[task]
         self.path_list = []
         self.path_len_list = []
-        self._construct_ref_path(self.task)
+        key = (self.task, CROSSROAD_SIZE, LANE_WIDTH, LANE_NUMBER)
+        if key not in _PATH_CACHE:
+            self._construct_ref_path(self.task)
+            # all paths of a task have the same length, stacked for per-row gathers, (path_num, 3, point_num)
+            path_stack = np.stack(self.path_list)
+            for arr in [path_stack] + self.path_list:
+                arr.setflags(write=False)  # shared by all instances
+            _PATH_CACHE[key] = self.path_list, self.path_len_list, path_stack
+        path_list, path_len_list, self._path_stack = _PATH_CACHE[key]
+        self.path_list, self.path_len_list = list(path_list), list(path_len_list)
         self.ref_index = np.random.choice(len(self.path_list)) if ref_index is None else ref_index
         self.path = self.path_list[self.ref_index]
+        self._kdtree, self._kdtree_path, self._kdtree_ratio = None, None, None
+        self._tracking_points = None, None  # (path, its points at index 1) for the dyna_traj tracking errors
 
     def set_path(self, traj_mode, path_index=None, path=None):
         self.traj_mode = traj_mode
+        self._kdtree = None
+        self._tracking_points = None, None
         if traj_mode == 'dyna_traj':
-            self.path = path
+            # kept as one (3, N) float32 array like the static paths, headings are added if only xs, ys are given
+            path = np.ascontiguousarray(path, dtype=np.float32)
+            self.path = _xys2path(path) if len(path) == 2 else path
         elif traj_mode == 'static_traj':
             self.ref_index = path_index
             self.path = self.path_list[self.ref_index]
@@ -550,9 +689,13 @@ class ReferencePath(object):
         sl = 40  # straight length
         meter_pointnum_ratio = 30
         control_ext = CROSSROAD_SIZE/3.
+        # straight line parts that do not depend on the offsets, shared by every path
+        ones_sl = np.ones(shape=(sl * meter_pointnum_ratio - 1,), dtype=np.float32)
+        start_straight_line_y = np.linspace(-CROSSROAD_SIZE/2 - sl, -CROSSROAD_SIZE/2, sl * meter_pointnum_ratio, dtype=np.float32)[:-1]
         if task == 'left':
             end_offsets = [LANE_WIDTH*(i+0.5) for i in range(LANE_NUMBER)]
             start_offsets = [LANE_WIDTH*0.5]
+            end_straight_line_x = np.linspace(-CROSSROAD_SIZE/2, -CROSSROAD_SIZE/2 - sl, sl * meter_pointnum_ratio, dtype=np.float32)[1:]
             for start_offset in start_offsets:
                 for end_offset in end_offsets:
                     control_point1 = start_offset, -CROSSROAD_SIZE/2
@@ -560,31 +703,25 @@ class ReferencePath(object):
                     control_point3 = -CROSSROAD_SIZE/2 + control_ext, end_offset
                     control_point4 = -CROSSROAD_SIZE/2, end_offset
 
-                    node = np.asfortranarray([[control_point1[0], control_point2[0], control_point3[0], control_point4[0]],
-                                              [control_point1[1], control_point2[1], control_point3[1], control_point4[1]]],
-                                             dtype=np.float32)
-                    curve = bezier.Curve(node, degree=3)
-                    s_vals = np.linspace(0, 1.0, int(pi/2*(CROSSROAD_SIZE/2+LANE_WIDTH/2)) * meter_pointnum_ratio)
-                    trj_data = curve.evaluate_multi(s_vals)
-                    trj_data = trj_data.astype(np.float32)
-                    start_straight_line_x = LANE_WIDTH/2 * np.ones(shape=(sl * meter_pointnum_ratio,), dtype=np.float32)[:-1]
-                    start_straight_line_y = np.linspace(-CROSSROAD_SIZE/2 - sl, -CROSSROAD_SIZE/2, sl * meter_pointnum_ratio, dtype=np.float32)[:-1]
-                    end_straight_line_x = np.linspace(-CROSSROAD_SIZE/2, -CROSSROAD_SIZE/2 - sl, sl * meter_pointnum_ratio, dtype=np.float32)[1:]
-                    end_straight_line_y = end_offset * np.ones(shape=(sl * meter_pointnum_ratio,), dtype=np.float32)[1:]
-                    planed_trj = np.append(np.append(start_straight_line_x, trj_data[0]), end_straight_line_x), \
-                                 np.append(np.append(start_straight_line_y, trj_data[1]), end_straight_line_y)
-
-                    xs_1, ys_1 = planed_trj[0][:-1], planed_trj[1][:-1]
-                    xs_2, ys_2 = planed_trj[0][1:], planed_trj[1][1:]
-                    phis_1 = np.arctan2(ys_2 - ys_1,
-                                        xs_2 - xs_1) * 180 / pi
-                    planed_trj = xs_1, ys_1, phis_1
+                    s_vals = np.linspace(0, 1.0, int(pi/2*(CROSSROAD_SIZE/2+LANE_WIDTH/2)) * meter_pointnum_ratio, dtype=np.float32)
+                    trj_data = eval_cubic_bezier(control_point1, control_point2, control_point3, control_point4, s_vals)
+                    start_straight_line_x = LANE_WIDTH/2 * ones_sl
+                    end_straight_line_y = end_offset * ones_sl
+                    curve_start = len(start_straight_line_x)
+                    curve_end = curve_start + len(trj_data[0])
+                    planed_trj = np.empty((2, curve_end + len(end_straight_line_x)), dtype=np.float32)
+                    planed_trj[0, :curve_start], planed_trj[1, :curve_start] = start_straight_line_x, start_straight_line_y
+                    planed_trj[:, curve_start:curve_end] = trj_data
+                    planed_trj[0, curve_end:], planed_trj[1, curve_end:] = end_straight_line_x, end_straight_line_y
+
+                    planed_trj = _xys2path(planed_trj)
                     self.path_list.append(planed_trj)
-                    self.path_len_list.append((sl * meter_pointnum_ratio, len(trj_data[0]), len(xs_1)))
+                    self.path_len_list.append((sl * meter_pointnum_ratio, len(trj_data[0]), planed_trj.shape[1]))
 
         elif task == 'straight':
             end_offsets = [LANE_WIDTH*(i+0.5) for i in range(LANE_NUMBER)]
             start_offsets = [LANE_WIDTH*1.5]
+            end_straight_line_y = np.linspace(CROSSROAD_SIZE/2, CROSSROAD_SIZE/2 + sl, sl * meter_pointnum_ratio, dtype=np.float32)[1:]
             for start_offset in start_offsets:
                 for end_offset in end_offsets:
                     control_point1 = start_offset, -CROSSROAD_SIZE/2
@@ -592,32 +729,26 @@ class ReferencePath(object):
                     control_point3 = end_offset, CROSSROAD_SIZE/2 - control_ext
                     control_point4 = end_offset, CROSSROAD_SIZE/2
 
-                    node = np.asfortranarray([[control_point1[0], control_point2[0], control_point3[0], control_point4[0]],
-                                              [control_point1[1], control_point2[1], control_point3[1], control_point4[1]]]
-                                             , dtype=np.float32)
-                    curve = bezier.Curve(node, degree=3)
-                    s_vals = np.linspace(0, 1.0, CROSSROAD_SIZE * meter_pointnum_ratio)
-                    trj_data = curve.evaluate_multi(s_vals)
-                    trj_data = trj_data.astype(np.float32)
-                    start_straight_line_x = start_offset * np.ones(shape=(sl * meter_pointnum_ratio,), dtype=np.float32)[:-1]
-                    start_straight_line_y = np.linspace(-CROSSROAD_SIZE/2 - sl, -CROSSROAD_SIZE/2, sl * meter_pointnum_ratio, dtype=np.float32)[:-1]
-                    end_straight_line_x = end_offset * np.ones(shape=(sl * meter_pointnum_ratio,), dtype=np.float32)[1:]
-                    end_straight_line_y = np.linspace(CROSSROAD_SIZE/2, CROSSROAD_SIZE/2 + sl, sl * meter_pointnum_ratio, dtype=np.float32)[1:]
-                    planed_trj = np.append(np.append(start_straight_line_x, trj_data[0]), end_straight_line_x), \
-                                 np.append(np.append(start_straight_line_y, trj_data[1]), end_straight_line_y)
-                    xs_1, ys_1 = planed_trj[0][:-1], planed_trj[1][:-1]
-                    xs_2, ys_2 = planed_trj[0][1:], planed_trj[1][1:]
-                    phis_1 = np.arctan2(ys_2 - ys_1,
-                                        xs_2 - xs_1) * 180 / pi
-                    planed_trj = xs_1, ys_1, phis_1
+                    s_vals = np.linspace(0, 1.0, CROSSROAD_SIZE * meter_pointnum_ratio, dtype=np.float32)
+                    trj_data = eval_cubic_bezier(control_point1, control_point2, control_point3, control_point4, s_vals)
+                    start_straight_line_x = start_offset * ones_sl
+                    end_straight_line_x = end_offset * ones_sl
+                    curve_start = len(start_straight_line_x)
+                    curve_end = curve_start + len(trj_data[0])
+                    planed_trj = np.empty((2, curve_end + len(end_straight_line_x)), dtype=np.float32)
+                    planed_trj[0, :curve_start], planed_trj[1, :curve_start] = start_straight_line_x, start_straight_line_y
+                    planed_trj[:, curve_start:curve_end] = trj_data
+                    planed_trj[0, curve_end:], planed_trj[1, curve_end:] = end_straight_line_x, end_straight_line_y
+                    planed_trj = _xys2path(planed_trj)
                     self.path_list.append(planed_trj)
-                    self.path_len_list.append((sl * meter_pointnum_ratio, len(trj_data[0]), len(xs_1)))
+                    self.path_len_list.append((sl * meter_pointnum_ratio, len(trj_data[0]), planed_trj.shape[1]))
 
         else:
             assert task == 'right'
             control_ext = CROSSROAD_SIZE/5.
             end_offsets = [-LANE_WIDTH*(i+0.5) for i in range(LANE_NUMBER)]
             start_offsets = [LANE_WIDTH*(LANE_NUMBER-0.5)]
+            end_straight_line_x = np.linspace(CROSSROAD_SIZE/2, CROSSROAD_SIZE/2 + sl, sl * meter_pointnum_ratio, dtype=np.float32)[1:]
 
             for start_offset in start_offsets:
                 for end_offset in end_offsets:
@@ -626,134 +757,145 @@ class ReferencePath(object):
                     control_point3 = CROSSROAD_SIZE/2 - control_ext, end_offset
                     control_point4 = CROSSROAD_SIZE/2, end_offset
 
-                    node = np.asfortranarray([[control_point1[0], control_point2[0], control_point3[0], control_point4[0]],
-                                              [control_point1[1], control_point2[1], control_point3[1], control_point4[1]]],
-                                             dtype=np.float32)
-                    curve = bezier.Curve(node, degree=3)
-                    s_vals = np.linspace(0, 1.0, int(pi/2*(CROSSROAD_SIZE/2-LANE_WIDTH*(LANE_NUMBER-0.5))) * meter_pointnum_ratio)
-                    trj_data = curve.evaluate_multi(s_vals)
-                    trj_data = trj_data.astype(np.float32)
-                    start_straight_line_x = start_offset * np.ones(shape=(sl * meter_pointnum_ratio,), dtype=np.float32)[:-1]
-                    start_straight_line_y = np.linspace(-CROSSROAD_SIZE/2 - sl, -CROSSROAD_SIZE/2, sl * meter_pointnum_ratio, dtype=np.float32)[:-1]
-                    end_straight_line_x = np.linspace(CROSSROAD_SIZE/2, CROSSROAD_SIZE/2 + sl, sl * meter_pointnum_ratio, dtype=np.float32)[1:]
-                    end_straight_line_y = end_offset * np.ones(shape=(sl * meter_pointnum_ratio,), dtype=np.float32)[1:]
-                    planed_trj = np.append(np.append(start_straight_line_x, trj_data[0]), end_straight_line_x), \
-                                 np.append(np.append(start_straight_line_y, trj_data[1]), end_straight_line_y)
-                    xs_1, ys_1 = planed_trj[0][:-1], planed_trj[1][:-1]
-                    xs_2, ys_2 = planed_trj[0][1:], planed_trj[1][1:]
-                    phis_1 = np.arctan2(ys_2 - ys_1,
-                                        xs_2 - xs_1) * 180 / pi
-                    planed_trj = xs_1, ys_1, phis_1
+                    s_vals = np.linspace(0, 1.0, int(pi/2*(CROSSROAD_SIZE/2-LANE_WIDTH*(LANE_NUMBER-0.5))) * meter_pointnum_ratio, dtype=np.float32)
+                    trj_data = eval_cubic_bezier(control_point1, control_point2, control_point3, control_point4, s_vals)
+                    start_straight_line_x = start_offset * ones_sl
+                    end_straight_line_y = end_offset * ones_sl
+                    curve_start = len(start_straight_line_x)
+                    curve_end = curve_start + len(trj_data[0])
+                    planed_trj = np.empty((2, curve_end + len(end_straight_line_x)), dtype=np.float32)
+                    planed_trj[0, :curve_start], planed_trj[1, :curve_start] = start_straight_line_x, start_straight_line_y
+                    planed_trj[:, curve_start:curve_end] = trj_data
+                    planed_trj[0, curve_end:], planed_trj[1, curve_end:] = end_straight_line_x, end_straight_line_y
+                    planed_trj = _xys2path(planed_trj)
                     self.path_list.append(planed_trj)
-                    self.path_len_list.append((sl * meter_pointnum_ratio, len(trj_data[0]), len(xs_1)))
+                    self.path_len_list.append((sl * meter_pointnum_ratio, len(trj_data[0]), planed_trj.shape[1]))
 
-    def find_closest_point(self, xs, ys, ratio=10):
-        path_len = len(self.path[0])
-        reduced_idx = np.arange(0, path_len, ratio)
-        reduced_len = len(reduced_idx)
-        reduced_path_x, reduced_path_y = self.path[0][reduced_idx], self.path[1][reduced_idx]
-        xs_tile = np.tile(np.reshape(xs, (-1, 1)), [1, reduced_len])
-        ys_tile = np.tile(np.reshape(ys, (-1, 1)), [1, reduced_len])
-        pathx_tile = np.tile(np.reshape(reduced_path_x, (1, -1)), [len(xs), 1])
-        pathy_tile = np.tile(np.reshape(reduced_path_y, (1, -1)), [len(xs), 1])
+    def _reduced_path_kdtree(self, ratio):  # kd-tree of every ratio-th point of self.path, rebuilt if the path changes
+        if self._kdtree is None or self._kdtree_path is not self.path or self._kdtree_ratio != ratio:
+            cKDTree = _import_ckdtree()
+            if cKDTree is None:
+                return None
+            self._kdtree = cKDTree(self.path[:2, ::ratio].T)
+            self._kdtree_path, self._kdtree_ratio = self.path, ratio
+        return self._kdtree
 
-        dist_array = np.square(xs_tile - pathx_tile) + np.square(ys_tile - pathy_tile)
-
-        indexs = np.argmin(dist_array, 1) * ratio
+    def find_closest_point(self, xs, ys, ratio=10):
+        kdtree = self._reduced_path_kdtree(ratio) if np.size(xs) >= _KDTREE_MIN_QUERIES else None
+        if kdtree is not None and kdtree.n < 2:  # short dyna_traj paths reduce to one point, no neighbours to pick from
+            kdtree = None
+        # every ratio-th path point is a strided view, broadcast against the column of ego points
+        reduced_path_x, reduced_path_y = self.path[0, ::ratio], self.path[1, ::ratio]
+        if kdtree is not None:
+            # the tree measures in float64, so near ties are settled between its two nearest points with the
+            # same distances and argmin as the scan below, sorted so that equal distances keep the lower index
+            _, candidates = kdtree.query(np.stack([np.reshape(xs, -1), np.reshape(ys, -1)], 1), k=2)
+            candidates.sort(1)
+            reduced_path_x, reduced_path_y = reduced_path_x[candidates], reduced_path_y[candidates]
+        dxs = np.reshape(xs, (-1, 1)) - reduced_path_x
+        dys = np.reshape(ys, (-1, 1)) - reduced_path_y
+        dxs *= dxs
+        dys *= dys
+        dxs += dys
+        indexs = np.argmin(dxs, 1)
+        if kdtree is not None:
+            indexs = candidates[np.arange(len(indexs)), indexs]
+        indexs = indexs * ratio
         return indexs, self.indexs2points(indexs)
 
     def future_n_data(self, current_indexs, n):
-        future_data_list = []
-        current_indexs = int(current_indexs)
-        for _ in range(n):
-            current_indexs += 80
-            current_indexs = np.where(current_indexs >= len(self.path[0]) - 2, len(self.path[0]) - 2, current_indexs)
-            future_data_list.append(self.indexs2points(current_indexs))
-        return future_data_list
+        # the indexes of all n future points, 80 points apart, (..., n), gathered at once
+        future_indexs = np.minimum(np.expand_dims(current_indexs, -1) + 80 * np.arange(1, n + 1),
+                                   self.path.shape[1] - 2)
+        future_points = self.path[:, future_indexs]
+        return [tuple(future_points[..., i]) for i in range(n)]
 
     def indexs2points(self, indexs):
-        indexs = np.where(indexs >= 0, indexs, 0)
-        indexs = np.where(indexs < len(self.path[0]), indexs, len(self.path[0])-1)
-        points = self.path[0][indexs], \
-                 self.path[1][indexs], \
-                 self.path[2][indexs]
+        indexs = np.clip(indexs, 0, self.path.shape[1] - 1)
+        points = self.path[:, indexs]  # one gather of x, y and phi
 
         return points[0], points[1], points[2]
 
-    def tracking_error_vector(self, ego_xs, ego_ys, ego_phis, ego_vs, n, func=None):
-        def two2one(ref_xs, ref_ys):
-            if self.task == 'left':
-                delta_ = np.sqrt(np.square(ego_xs - (-CROSSROAD_SIZE/2)) + np.square(ego_ys - (-CROSSROAD_SIZE/2))) - \
-                         np.sqrt(np.square(ref_xs - (-CROSSROAD_SIZE/2)) + np.square(ref_ys - (-CROSSROAD_SIZE/2)))
-                delta_ = np.where(ego_ys < -CROSSROAD_SIZE/2, ego_xs - ref_xs, delta_)
-                delta_ = np.where(ego_xs < -CROSSROAD_SIZE/2, ego_ys - ref_ys, delta_)
-                return -delta_
-            elif self.task == 'straight':
-                delta_ = ego_xs - ref_xs
-                return -delta_
-            else:
-                assert self.task == 'right'
-                delta_ = -(np.sqrt(np.square(ego_xs - CROSSROAD_SIZE/2) + np.square(ego_ys - (-CROSSROAD_SIZE/2))) -
-                           np.sqrt(np.square(ref_xs - CROSSROAD_SIZE/2) + np.square(ref_ys - (-CROSSROAD_SIZE/2))))
-                delta_ = np.where(ego_ys < -CROSSROAD_SIZE/2, ego_xs - ref_xs, delta_)
-                delta_ = np.where(ego_xs > CROSSROAD_SIZE/2, -(ego_ys - ref_ys), delta_)
-                return -delta_
+    def reduced_paths(self, ref_indexes, ratio=10):  # (B, 2, reduced_len), xy of every ratio-th point per row
+        return self._path_stack[np.asarray(ref_indexes), :2, ::ratio]
+
+    def tracking_error_vector_batched(self, ego_xs, ego_ys, ego_phis, ego_vs, n, ref_indexes, ratio=10,
+                                      reduced_paths=None):
+        """
+        static_traj tracking errors of tracking_error_vector, where row i is tracked on path_list[ref_indexes[i]]
+        instead of on self.path, so that a batch over several ref paths needs no loop over the paths.
+        reduced_paths may be passed in from reduced_paths(ref_indexes, ratio) if ref_indexes stay the same
+        """
+        ref_indexes = np.asarray(ref_indexes)
+        path_len = self._path_stack.shape[2]
+        if reduced_paths is None:
+            reduced_paths = self.reduced_paths(ref_indexes, ratio)
+        dist_array = np.square(ego_xs[:, np.newaxis] - reduced_paths[:, 0]) + \
+                     np.square(ego_ys[:, np.newaxis] - reduced_paths[:, 1])
+        indexs = np.argmin(dist_array, 1) * ratio
 
+        current_points = self._path_stack[ref_indexes, :, indexs]  # (B, 3)
+        final = np.empty((len(ego_xs), 3 * (n + 1)), dtype=np.result_type(ego_xs, current_points))
+        final[:, 0] = self._two2one(ego_xs, ego_ys, current_points[:, 0], current_points[:, 1])
+        final[:, 1] = deal_with_phi_diff(ego_phis - current_points[:, 2])
+        final[:, 2] = ego_vs - self.exp_v
+        for i in range(1, n + 1):
+            future_points = self._path_stack[ref_indexes, :, np.minimum(indexs + 80 * i, path_len - 2)]
+            final[:, 3 * i] = future_points[:, 0] - ego_xs
+            final[:, 3 * i + 1] = future_points[:, 1] - ego_ys
+            final[:, 3 * i + 2] = deal_with_phi_diff(ego_phis - future_points[:, 2])
+        return final
+
+    def tracking_error_vector(self, ego_xs, ego_ys, ego_phis, ego_vs, n, func=None):
         if self.traj_mode == 'dyna_traj':
             if func == 'tracking':
                 indexs = 1
-                current_points = self.indexs2points(indexs)
-                n_future_data = self.future_n_data(indexs, n)
-                all_ref = [current_points] + n_future_data
-                print(current_points)
-
-                tracking_error = np.concatenate((np.stack([two2one(ref_point[0], ref_point[1]),
-                                                      deal_with_phi_diff(ego_phis - ref_point[2]),
-                                                      ego_vs - self.exp_v], 1)
-                                            for ref_point in all_ref), 1)
-
+                if self._tracking_points[0] is not self.path:
+                    self._tracking_points = self.path, self.indexs2points(indexs)
+                current_points = self._tracking_points[1]
             else:
                 indexs, current_points = self.find_closest_point(ego_xs, ego_ys)
                 # print('Index:', indexs.numpy(), 'points:', current_points[:])
-                n_future_data = self.future_n_data(indexs, n)
-                all_ref = [current_points] + n_future_data
-
-                tracking_error = np.concatenate((np.stack([two2one(ref_point[0], ref_point[1]),
-                                                           deal_with_phi_diff(ego_phis - ref_point[2]),
-                                                           ego_vs - self.exp_v], 1)
-                                                 for ref_point in all_ref), 1)
-            final = None
+            n_future_data = self.future_n_data(indexs, n)
+
+            # every ref point, the current one included, gives a (position, phi, v) error block
+            final = np.empty((len(ego_xs), 3 * (n + 1)), dtype=np.result_type(ego_xs, current_points[0]))
+            for i, ref_point in enumerate([current_points] + n_future_data):
+                final[:, 3 * i] = self._two2one(ego_xs, ego_ys, ref_point[0], ref_point[1])
+                final[:, 3 * i + 1] = deal_with_phi_diff(ego_phis - ref_point[2])
+                final[:, 3 * i + 2] = ego_vs - self.exp_v
         else:
             indexs, current_points = self.find_closest_point(ego_xs, ego_ys)
             # print('Index:', indexs.numpy(), 'points:', current_points[:])
             n_future_data = self.future_n_data(indexs, n)
 
-            tracking_error = np.stack([two2one(current_points[0], current_points[1]),
-                                               deal_with_phi_diff(ego_phis - current_points[2]),
-                                               ego_vs - self.exp_v], 1)
-
-            final = tracking_error
-            if n > 0:
-                future_points = np.concatenate((np.stack([ref_point[0] - ego_xs,
-                                                     ref_point[1] - ego_ys,
-                                                     deal_with_phi_diff(ego_phis - ref_point[2])], 1)
-                                           for ref_point in n_future_data), 1)
-                final = np.concatenate((final, future_points), 1)
+            # the current tracking error and the n future points are written column by column into one array
+            final = np.empty((len(ego_xs), 3 * (n + 1)), dtype=np.result_type(ego_xs, current_points[0]))
+            final[:, 0] = self._two2one(ego_xs, ego_ys, current_points[0], current_points[1])
+            final[:, 1] = deal_with_phi_diff(ego_phis - current_points[2])
+            final[:, 2] = ego_vs - self.exp_v
+            for i, ref_point in enumerate(n_future_data, 1):
+                final[:, 3 * i] = ref_point[0] - ego_xs
+                final[:, 3 * i + 1] = ref_point[1] - ego_ys
+                final[:, 3 * i + 2] = deal_with_phi_diff(ego_phis - ref_point[2])
 
         return final
 
     def plot_path(self, x, y):
-        plt.axis('equal')
-        plt.plot(self.path_list[0][0], self.path_list[0][1], 'b')
-        plt.plot(self.path_list[1][0], self.path_list[1][1], 'r')
-        plt.plot(self.path_list[2][0], self.path_list[2][1], 'g')
+        import matplotlib.pyplot as plt
+        fig, ax = plt.subplots(layout='constrained')
+        ax.axis('equal')
+        ax.plot(self.path_list[0][0], self.path_list[0][1], 'b')
+        ax.plot(self.path_list[1][0], self.path_list[1][1], 'r')
+        ax.plot(self.path_list[2][0], self.path_list[2][1], 'g')
         print(self.path_len_list)
 
         index, closest_point = self.find_closest_point(np.array([x], np.float32),
                                                        np.array([y], np.float32))
-        plt.plot(x, y, 'b*')
-        plt.plot(closest_point[0], closest_point[1], 'ro')
+        ax.plot(x, y, 'b*')
+        ax.plot(closest_point[0], closest_point[1], 'ro')
         plt.show()
+        plt.close(fig)
 
 
 def test_ref_path():
@@ -762,15 +904,18 @@ def test_ref_path():
 
 
 def test_future_n_data():
+    import matplotlib.pyplot as plt
     path = ReferencePath('straight')
-    plt.axis('equal')
+    fig, ax = plt.subplots(layout='constrained')
+    ax.axis('equal')
     current_i = 600
-    plt.plot(path.path[0], path.path[1])
+    ax.plot(path.path[0], path.path[1])
     future_data_list = path.future_n_data(current_i, 5)
-    plt.plot(path.indexs2points(current_i)[0], path.indexs2points(current_i)[1], 'go')
+    ax.plot(path.indexs2points(current_i)[0], path.indexs2points(current_i)[1], 'go')
     for point in future_data_list:
-        plt.plot(point[0], point[1], 'r*')
+        ax.plot(point[0], point[1], 'r*')
     plt.show()
+    plt.close(fig)
 
 
 def test_tracking_error_vector():
@@ -12,7 +12,6 @@ from collections import OrderedDict
 from math import cos, sin, pi
 
 import gym
-import matplotlib.pyplot as plt
 import numpy as np
 from numpy import logical_and
 from gym.utils import seeding
@@ -87,9 +86,9 @@ class CrossroadEnd2end3way(gym.Env):
             action = self.action_space.sample()
             observation, _reward, done, _info = self.step(action)
             self._set_observation_space(observation)
-            plt.ion()
         self.obs = None
         self.action = None
+        self._render_initialized = False
 
 
 
@@ -684,6 +683,10 @@ class CrossroadEnd2end3way(gym.Env):
 
     def render(self, mode='human'):
         if mode == 'human':
+            import matplotlib.pyplot as plt  # only needed for rendering, kept out of the training import path
+            if not self._render_initialized:
+                plt.ion()
+                self._render_initialized = True
             # plot basic map
             square_length = CROSSROAD_SIZE
             extension = 40
@@ -912,45 +915,44 @@ class CrossroadEnd2end3way(gym.Env):
 
             # plot ego dynamics
             text_x, text_y_start = -110, 60
-            ge = iter(range(0, 1000, 4))
-            plt.text(text_x, text_y_start - next(ge), 'ego_x: {:.2f}m'.format(ego_x))
-            plt.text(text_x, text_y_start - next(ge), 'ego_y: {:.2f}m'.format(ego_y))
-            plt.text(text_x, text_y_start - next(ge), 'path_x: {:.2f}m'.format(path_x))
-            plt.text(text_x, text_y_start - next(ge), 'path_y: {:.2f}m'.format(path_y))
-            plt.text(text_x, text_y_start - next(ge), 'delta_: {:.2f}m'.format(delta_))
-            plt.text(text_x, text_y_start - next(ge), 'delta_x: {:.2f}m'.format(delta_x))
-            plt.text(text_x, text_y_start - next(ge), 'delta_y: {:.2f}m'.format(delta_y))
-            plt.text(text_x, text_y_start - next(ge), r'ego_phi: ${:.2f}\degree$'.format(ego_phi))
-            plt.text(text_x, text_y_start - next(ge), r'path_phi: ${:.2f}\degree$'.format(path_phi))
-            plt.text(text_x, text_y_start - next(ge), r'delta_phi: ${:.2f}\degree$'.format(delta_phi))
-
-            plt.text(text_x, text_y_start - next(ge), 'v_x: {:.2f}m/s'.format(ego_v_x))
-            plt.text(text_x, text_y_start - next(ge), 'exp_v: {:.2f}m/s'.format(self.exp_v))
-            plt.text(text_x, text_y_start - next(ge), 'v_y: {:.2f}m/s'.format(ego_v_y))
-            plt.text(text_x, text_y_start - next(ge), 'yaw_rate: {:.2f}rad/s'.format(ego_r))
-            plt.text(text_x, text_y_start - next(ge), 'yaw_rate bound: [{:.2f}, {:.2f}]'.format(-r_bound, r_bound))
-
-            plt.text(text_x, text_y_start - next(ge), r'$\alpha_f$: {:.2f} rad'.format(ego_alpha_f))
-            plt.text(text_x, text_y_start - next(ge), r'$\alpha_f$ bound: [{:.2f}, {:.2f}] '.format(-alpha_f_bound,
-                                                                                                        alpha_f_bound))
-            plt.text(text_x, text_y_start - next(ge), r'$\alpha_r$: {:.2f} rad'.format(ego_alpha_r))
-            plt.text(text_x, text_y_start - next(ge), r'$\alpha_r$ bound: [{:.2f}, {:.2f}] '.format(-alpha_r_bound,
-                                                                                                        alpha_r_bound))
+            texts = ['ego_x: {:.2f}m'.format(ego_x),
+                     'ego_y: {:.2f}m'.format(ego_y),
+                     'path_x: {:.2f}m'.format(path_x),
+                     'path_y: {:.2f}m'.format(path_y),
+                     'delta_: {:.2f}m'.format(delta_),
+                     'delta_x: {:.2f}m'.format(delta_x),
+                     'delta_y: {:.2f}m'.format(delta_y),
+                     r'ego_phi: ${:.2f}\degree$'.format(ego_phi),
+                     r'path_phi: ${:.2f}\degree$'.format(path_phi),
+                     r'delta_phi: ${:.2f}\degree$'.format(delta_phi),
+
+                     'v_x: {:.2f}m/s'.format(ego_v_x),
+                     'exp_v: {:.2f}m/s'.format(self.exp_v),
+                     'v_y: {:.2f}m/s'.format(ego_v_y),
+                     'yaw_rate: {:.2f}rad/s'.format(ego_r),
+                     'yaw_rate bound: [{:.2f}, {:.2f}]'.format(-r_bound, r_bound),
+
+                     r'$\alpha_f$: {:.2f} rad'.format(ego_alpha_f),
+                     r'$\alpha_f$ bound: [{:.2f}, {:.2f}] '.format(-alpha_f_bound, alpha_f_bound),
+                     r'$\alpha_r$: {:.2f} rad'.format(ego_alpha_r),
+                     r'$\alpha_r$ bound: [{:.2f}, {:.2f}] '.format(-alpha_r_bound, alpha_r_bound)]
             if self.action is not None:
                 steer, a_x = self.action[0], self.action[1]
-                plt.text(text_x, text_y_start - next(ge), r'steer: {:.2f}rad (${:.2f}\degree$)'.format(steer, steer * 180 / np.pi))
-                plt.text(text_x, text_y_start - next(ge), 'a_x: {:.2f}m/s^2'.format(a_x))
+                texts += [r'steer: {:.2f}rad (${:.2f}\degree$)'.format(steer, steer * 180 / np.pi),
+                          'a_x: {:.2f}m/s^2'.format(a_x)]
+            for text_y, text in zip(text_y_start - 4 * np.arange(len(texts)), texts):
+                plt.text(text_x, text_y, text)
 
             text_x, text_y_start = 70, 60
-            ge = iter(range(0, 1000, 4))
 
             # done info
-            plt.text(text_x, text_y_start - next(ge), 'done info: {}'.format(self.done_type))
+            texts = ['done info: {}'.format(self.done_type)]
 
             # reward info
             if self.reward_info is not None:
-                for key, val in self.reward_info.items():
-                    plt.text(text_x, text_y_start - next(ge), '{}: {:.4f}'.format(key, val))
+                texts += ['{}: {:.4f}'.format(key, val) for key, val in self.reward_info.items()]
+            for text_y, text in zip(text_y_start - 4 * np.arange(len(texts)), texts):
+                plt.text(text_x, text_y, text)
 
             # indicator for trajectory selection
             text_x, text_y_start = -25, -65
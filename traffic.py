@@ -13,7 +13,7 @@ import os
 import random
 import sys
 from collections import defaultdict
-from math import fabs, cos, sin, pi
+from math import pi
 
 if 'SUMO_HOME' in os.environ:
     tools = os.path.join(os.environ['SUMO_HOME'], 'tools')
@@ -21,6 +21,8 @@ if 'SUMO_HOME' in os.environ:
 else:
     sys.exit("please declare environment variable 'SUMO_HOME'")
 
+import numpy as np
+from numpy import logical_and
 import sumolib
 from sumolib import checkBinary
 import traci
@@ -32,6 +34,12 @@ SUMO_BINARY = checkBinary('sumo')
 SIM_PERIOD = 1.0 / 10
 
 
+def _front_rear_points(vehs):  # rows of (x, y, phi, l, w) -> (N, front/rear, xy)
+    lws = (vehs[:, 3] - vehs[:, 4]) / 2
+    offsets = lws[:, np.newaxis] * np.stack([np.cos(vehs[:, 2] / 180 * pi), np.sin(vehs[:, 2] / 180 * pi)], 1)
+    return np.stack([vehs[:, :2] + offsets, vehs[:, :2] - offsets], 1)
+
+
 class Traffic(object):
 
     def __init__(self, step_length, mode, init_n_ego_dict, training_task='left'):  # mode 'display' or 'training'
@@ -260,34 +268,19 @@ class Traffic(object):
     def collision_check(self):  # True: collision
         flag_dict = dict()
         for egoID, list_of_veh_dict in self.n_ego_vehicles.items():
-            ego_x = self.n_ego_dict[egoID]['x']
-            ego_y = self.n_ego_dict[egoID]['y']
-            ego_phi = self.n_ego_dict[egoID]['phi']
-            ego_l = self.n_ego_dict[egoID]['l']
-            ego_w = self.n_ego_dict[egoID]['w']
-            ego_lw = (ego_l - ego_w) / 2
-            ego_x0 = (ego_x + cos(ego_phi / 180 * pi) * ego_lw)
-            ego_y0 = (ego_y + sin(ego_phi / 180 * pi) * ego_lw)
-            ego_x1 = (ego_x - cos(ego_phi / 180 * pi) * ego_lw)
-            ego_y1 = (ego_y - sin(ego_phi / 180 * pi) * ego_lw)
+            ego = self.n_ego_dict[egoID]
             flag_dict[egoID] = False
-
-            for veh in list_of_veh_dict:
-                if fabs(veh['x'] - ego_x) < 10 and fabs(veh['y'] - ego_y) < 10:
-                    surrounding_lw = (veh['l'] - veh['w']) / 2
-                    surrounding_x0 = (veh['x'] + cos(veh['phi'] / 180 * pi) * surrounding_lw)
-                    surrounding_y0 = (veh['y'] + sin(veh['phi'] / 180 * pi) * surrounding_lw)
-                    surrounding_x1 = (veh['x'] - cos(veh['phi'] / 180 * pi) * surrounding_lw)
-                    surrounding_y1 = (veh['y'] - sin(veh['phi'] / 180 * pi) * surrounding_lw)
-                    collision_check_dis = ((veh['w'] + ego_w) / 2 + 0.5) ** 2
-                    if (ego_x0 - surrounding_x0) ** 2 + (ego_y0 - surrounding_y0) ** 2 < collision_check_dis:
-                        flag_dict[egoID] = True
-                    elif (ego_x0 - surrounding_x1) ** 2 + (ego_y0 - surrounding_y1) ** 2 < collision_check_dis:
-                        flag_dict[egoID] = True
-                    elif (ego_x1 - surrounding_x1) ** 2 + (ego_y1 - surrounding_y1) ** 2 < collision_check_dis:
-                        flag_dict[egoID] = True
-                    elif (ego_x1 - surrounding_x0) ** 2 + (ego_y1 - surrounding_y0) ** 2 < collision_check_dis:
-                        flag_dict[egoID] = True
+            if not list_of_veh_dict:
+                continue
+            # all surrounding vehs of this ego at once, (x, y, phi, l, w) per row
+            vehs = np.array([[veh['x'], veh['y'], veh['phi'], veh['l'], veh['w']] for veh in list_of_veh_dict])
+            vehs = vehs[logical_and(np.abs(vehs[:, 0] - ego['x']) < 10, np.abs(vehs[:, 1] - ego['y']) < 10)]
+            ego_pts = _front_rear_points(np.array([[ego['x'], ego['y'], ego['phi'], ego['l'], ego['w']]]))
+            veh_pts = _front_rear_points(vehs)  # (veh_num, 2, 2)
+            # squared dists of every (ego point, veh point) pair, (veh_num, 2, 2)
+            dists = np.square(ego_pts[:, :, np.newaxis, :] - veh_pts[:, np.newaxis, :, :]).sum(-1)
+            collision_check_dis = np.square((vehs[:, 4] + ego['w']) / 2 + 0.5)
+            flag_dict[egoID] = bool(np.any(dists < collision_check_dis[:, np.newaxis, np.newaxis]))
 
         self.n_ego_collision_flag = flag_dict
 